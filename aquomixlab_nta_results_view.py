@@ -1,8 +1,188 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
+import numpy as np
 import io
 
+# --- Pick the fastest available Excel engine ---
+# calamine (python-calamine) parses xlsx several times faster than openpyxl;
+# fall back to openpyxl so deployments without calamine still work.
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
+
+
+# Columns of the data sheet the app actually uses, and their dtypes. Explicit
+# dtypes skip pandas' per-cell type inference; 'category' makes unique() on
+# Compound Class proportional to the number of classes instead of rows.
+REQUIRED_DATA_COLS = ['id', 'Consensus annotation', 'Compound Class']
+DATA_COL_DTYPES = {'id': 'string', 'Consensus annotation': 'string', 'Compound Class': 'category'}
+
+# --- Cached Excel parsing ---
+# Streamlit re-runs the whole script on every widget interaction, so parsing
+# the uploaded files must not happen on each rerun. These helpers are keyed on
+# the raw file bytes: after the first upload, reruns are cache lookups.
+
+def _open_workbook_readonly(xlsx_bytes):
+    """Open a workbook with openpyxl in read-only, values-only mode.
+
+    The default openpyxl loader builds a Python cell object for every cell,
+    which is slow and can need orders of magnitude more RAM than the file
+    itself. Read-only mode streams rows and keeps memory near the file size.
+    """
+    import openpyxl
+    return openpyxl.load_workbook(io.BytesIO(xlsx_bytes), read_only=True, data_only=True)
+
+def _rows_to_df(rows, header):
+    """Build a DataFrame from streamed row tuples, optionally using the first row as header."""
+    if header:
+        columns = list(rows[0]) if rows else []
+        return pd.DataFrame(rows[1:], columns=columns)
+    return pd.DataFrame(rows)
+
+def _trim_and_type_data(data_df):
+    """Drop unused metadata columns and apply explicit dtypes (fallback path)."""
+    keep = [c for c in REQUIRED_DATA_COLS if c in data_df.columns] + list(data_df.columns[5:])
+    data_df = data_df[keep]
+    dtypes = {c: t for c, t in DATA_COL_DTYPES.items() if c in data_df.columns}
+    return data_df.astype(dtypes)
+
+def _downcast_samples(data_df):
+    """Store sample intensities as float32.
+
+    float32 is more than enough precision for boxplot display and halves both
+    the cached frame's memory and the bytes moved when slicing sample columns.
+    """
+    sample_cols = [c for c in data_df.columns if c not in REQUIRED_DATA_COLS]
+    data_df[sample_cols] = data_df[sample_cols].astype('float32')
+    return data_df
+
+@st.cache_data
+def _load_data_workbook(xlsx_bytes):
+    """Read the data workbook: the info preview (sheet 2) and the main dataset (sheet 1).
+
+    Opening the workbook once via pd.ExcelFile parses the ZIP container and
+    shared-strings table a single time for both sheets instead of twice.
+    Returns (info_df, data_df); info_df is None if the second sheet is missing
+    or unreadable.
+    """
+    if EXCEL_ENGINE == "openpyxl":
+        # Fallback path: stream rows in read-only mode instead of letting
+        # pd.read_excel materialize the whole workbook DOM.
+        wb = _open_workbook_readonly(xlsx_bytes)
+        try:
+            try:
+                # max_row stops the XML parse after the preview rows instead
+                # of scanning the whole sheet and slicing afterwards
+                info_rows = list(wb[wb.sheetnames[1]].iter_rows(max_row=5, values_only=True))
+                info_df = _rows_to_df(info_rows, header=False)
+            except Exception:
+                info_df = None
+            data_rows = list(wb[wb.sheetnames[0]].iter_rows(values_only=True))
+            data_df = _downcast_samples(_trim_and_type_data(_rows_to_df(data_rows, header=True)))
+        finally:
+            wb.close()
+        return info_df, data_df
+
+    with pd.ExcelFile(io.BytesIO(xlsx_bytes), engine=EXCEL_ENGINE) as xl:
+        try:
+            info_df = xl.parse(sheet_name=1, header=None, nrows=5)
+        except Exception:
+            info_df = None
+        # Two-phase read: grab the header alone, then read only the columns
+        # the app uses (required columns plus samples, i.e. column 6 onwards).
+        header = xl.parse(sheet_name=0, nrows=0).columns
+        keep_cols = set(REQUIRED_DATA_COLS).union(header[5:])
+        dtypes = {c: t for c, t in DATA_COL_DTYPES.items() if c in header}
+        data_df = xl.parse(sheet_name=0, usecols=lambda c: c in keep_cols, dtype=dtypes)
+    return info_df, _downcast_samples(data_df)
+
+@st.cache_data
+def _load_metadata(xlsx_bytes):
+    """Read the sample metadata table."""
+    if EXCEL_ENGINE == "openpyxl":
+        wb = _open_workbook_readonly(xlsx_bytes)
+        try:
+            rows = list(wb[wb.sheetnames[0]].iter_rows(values_only=True))
+        finally:
+            wb.close()
+        return _rows_to_df(rows, header=True)
+    return pd.read_excel(io.BytesIO(xlsx_bytes), engine=EXCEL_ENGINE)
+
+@st.cache_data
+def _feature_index(xlsx_bytes):
+    """Per-class feature lookup table, built once per upload.
+
+    Maps compound class -> {id: (display_name, annotation, row_position)},
+    plus an 'All' entry covering every feature. The class filter, the feature
+    selectbox and the plot-time metadata/row lookup all become dict operations
+    with no DataFrame scans in the rerun hot path.
+    """
+    _, data_df = _load_data_workbook(xlsx_bytes)
+    # Both columns are string dtype, so str.cat is a single vectorized pass
+    display_names = data_df['id'].str.cat(data_df['Consensus annotation'], sep=" - ", na_rep="nan")
+    entries = dict(zip(data_df['id'], zip(display_names, data_df['Consensus annotation'], range(len(data_df)))))
+    index = {'All': entries}
+    ids = data_df['id']
+    for cls, rows in data_df.groupby('Compound Class', sort=False, observed=True).indices.items():
+        index[cls] = {fid: entries[fid] for fid in ids.iloc[rows]}
+    return index
+
+@st.cache_data
+def _group_lookup(xlsx_bytes, group):
+    """Sample -> attribute Series for one metadata column.
+
+    Mapping samples through this indexed Series is a plain hash lookup,
+    which is much cheaper than a pd.merge for a single-column join.
+    """
+    return _load_metadata(xlsx_bytes).set_index('Sample')[group]
+
+def _box_stats(values):
+    """Tukey box statistics (1.5*IQR fences) for one group of values.
+
+    Returns (q1, median, q3, lowerfence, upperfence, outliers), or None if
+    the group has no finite values.
+    """
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return None
+    q1, median, q3 = np.percentile(values, [25, 50, 75])
+    iqr = q3 - q1
+    in_fence = values[(values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)]
+    lower, upper = in_fence.min(), in_fence.max()
+    outliers = values[(values < lower) | (values > upper)]
+    return q1, median, q3, lower, upper, outliers
+
+@st.cache_data(show_spinner=False)
+def _render_figure(fig_json, fmt):
+    """Render a figure to image bytes, cached on its JSON serialization.
+
+    kaleido rendering is the heaviest operation in the app. Keying on the
+    serialized figure plus the format means reruns and repeated clicks reuse
+    the already-rendered bytes instead of spinning kaleido up again. PNG is
+    derived from the (cached) SVG render via cairosvg when available, so
+    kaleido runs at most once per figure.
+    """
+    if fmt == "png":
+        try:
+            import cairosvg
+        except (ImportError, OSError):
+            # OSError: cairosvg is installed but the system cairo library
+            # is missing; fall back to a direct kaleido PNG render
+            cairosvg = None
+        if cairosvg is not None:
+            # Rasterizing the SVG is far cheaper than a second kaleido
+            # round trip; dimensions match the kaleido output (scale=2)
+            return cairosvg.svg2png(bytestring=_render_figure(fig_json, "svg"),
+                                    output_width=2000, output_height=1200)
+    import plotly.io as pio
+    fig = pio.from_json(fig_json)
+    buffer = io.BytesIO()
+    fig.write_image(buffer, format=fmt, width=1000, height=600, scale=2)
+    return buffer.getvalue()
+
+
 def main():
     """
     Main function to run the Streamlit application.
@@ -44,33 +224,38 @@ def main():
     # --- Main App Logic ---
     if data_file is not None and metadata_file is not None:
         try:
+            # Read the uploaded bytes once; they are hashable, so the cached
+            # loaders only parse each file the first time it is seen. Going
+            # through bytes also sidesteps the classic seek(0) footgun of
+            # re-reading an UploadedFile, and dropping the file references
+            # here lets the per-run buffers be collected early.
+            data_bytes = data_file.getvalue()
+            metadata_bytes = metadata_file.getvalue()
+            del data_file, metadata_file
+
+            # Parse both sheets of the data workbook in a single pass
+            info_df, data_df = _load_data_workbook(data_bytes)
+            metadata_df = _load_metadata(metadata_bytes)
+
             # --- NEW: Read and display information from Sheet2 ---
-            try:
-                # Read the first 5 rows from the second sheet (index 1)
-                info_df = pd.read_excel(data_file, sheet_name=1, header=None, nrows=5)
-                if not info_df.empty:
-                    with st.expander("Show Dataset Information", expanded=True):
-                        # Iterate through the rows and display them
-                        for index, row in info_df.iterrows():
-                            # Check if both columns exist to prevent errors
-                            if len(row) >= 2 and pd.notna(row[0]) and pd.notna(row[1]):
-                                st.markdown(f"**{row[0]}:** {row[1]}")
-                            elif pd.notna(row[0]):
-                                st.markdown(f"**{row[0]}**")
-            except Exception:
+            if info_df is not None and not info_df.empty:
+                with st.expander("Show Dataset Information", expanded=True):
+                    # Iterate through the rows and display them
+                    for index, row in info_df.iterrows():
+                        # Check if both columns exist to prevent errors
+                        if len(row) >= 2 and pd.notna(row[0]) and pd.notna(row[1]):
+                            st.markdown(f"**{row[0]}:** {row[1]}")
+                        elif pd.notna(row[0]):
+                            st.markdown(f"**{row[0]}**")
+            elif info_df is None:
                 # If Sheet2 doesn't exist or there's an error, just show a warning
                 st.warning("Could not read dataset information from the second sheet of the data file.")
 
-
-            # Load the main data from the first sheet (index 0)
-            data_df = pd.read_excel(data_file, sheet_name=0)
-            metadata_df = pd.read_excel(metadata_file)
-
             # --- Data Validation ---
             # Check for essential columns in the data file
-            required_data_cols = ['id', 'Consensus annotation', 'Compound Class']
-            if not all(col in data_df.columns for col in required_data_cols):
-                st.error(f"Data file is missing one or more required columns: {required_data_cols}")
+            missing_cols = set(REQUIRED_DATA_COLS).difference(data_df.columns)
+            if missing_cols:
+                st.error(f"Data file is missing one or more required columns: {sorted(missing_cols)}")
                 return
 
             # Check for essential columns in the metadata file
@@ -85,8 +270,9 @@ def main():
             # --- Column 1: Sample Selection ---
             with col1:
                 st.subheader("1. Select Samples")
-                # Extract sample columns from the data file (all columns from F onwards)
-                sample_cols = data_df.columns[5:].tolist()
+                # Extract sample columns from the data file (the loader keeps
+                # only the required columns plus the sample columns)
+                sample_cols = [col for col in data_df.columns if col not in REQUIRED_DATA_COLS]
                 selected_samples = st.multiselect(
                     "Choose samples to include:",
                     options=sample_cols,
@@ -99,35 +285,37 @@ def main():
 
             # --- Control 3: Feature Filtering (at the bottom) ---
             st.subheader("3. Filter Features")
-            # Get unique compound classes for filtering
-            compound_classes = ['All'] + sorted(data_df['Compound Class'].unique().tolist())
+            # Get unique compound classes for filtering. Compound Class is
+            # categorical, so the sorted unique values are already precomputed
+            # as category metadata — no unique()+sort pass per rerun.
+            compound_classes = ['All'] + list(data_df['Compound Class'].cat.categories)
             selected_class = st.selectbox(
                 "Filter by Compound Class:",
                 options=compound_classes
             )
 
-            # Filter data based on selected compound class
-            if selected_class != 'All':
-                filtered_data_df = data_df[data_df['Compound Class'] == selected_class].copy()
-            else:
-                filtered_data_df = data_df.copy()
+            # Filter features through the per-class index built once per
+            # upload: changing the class selection does no DataFrame work.
+            class_features = _feature_index(data_bytes).get(selected_class, {})
 
-            if filtered_data_df.empty:
+            if not class_features:
                 st.warning(f"No features found for the compound class: '{selected_class}'")
                 # We must stop the script here if no features are available.
                 return
-            
-            # Generate feature options based on the filter
-            filtered_data_df['display_name'] = filtered_data_df['id'].astype(str) + " - " + filtered_data_df['Consensus annotation'].astype(str)
-            feature_options = filtered_data_df['display_name'].tolist()
+
+            # The selectbox operates on the (short) ids and renders the longer
+            # display names through format_func, keeping its payload small on
+            # feature-rich datasets.
+            feature_ids = list(class_features)
 
             # --- Column 2: Feature Selection and Grouping ---
             with col2:
                 st.subheader("2. Select Feature and Group")
                 
-                selected_feature_display_name = st.selectbox(
+                selected_feature_id = st.selectbox(
                     "Select a feature to create a boxplot:",
-                    options=feature_options,
+                    options=feature_ids,
+                    format_func=lambda fid: class_features[fid][0],
                 )
 
                 # Allow user to select a metadata attribute for grouping, including 'Sample'
@@ -141,26 +329,34 @@ def main():
                     options=grouping_options
                 )
 
-            # Get the actual ID from the selected display name
-            selected_feature_id = filtered_data_df[filtered_data_df['display_name'] == selected_feature_display_name]['id'].iloc[0]
-
-
             # --- Boxplot Generation ---
+            # Drawing every sample point scales poorly past a few thousand
+            # samples (browser render and exported image size), so show only
+            # outliers by default and let the user opt in to all points.
+            show_all_points = st.checkbox("Show individual data points", value=False)
+
             if st.button("Generate Boxplot"):
+                # Plotly is only needed from this point on; importing it
+                # lazily keeps reruns that never plot from paying the import
+                # (tens of ms plus several MB of memory per session).
+                import plotly.express as px
+
                 st.header(f"Boxplot for Feature: {selected_feature_id}")
-                # Get the selected feature's data
-                feature_data = filtered_data_df[filtered_data_df['id'] == selected_feature_id]
-                compound_name = feature_data['Consensus annotation'].iloc[0]
+                # Get the selected feature's metadata and row straight from
+                # the index — no boolean mask over the id column
+                _display_name, compound_name, row_pos = class_features[selected_feature_id]
                 st.subheader(f"Compound: {compound_name}")
 
-                # Prepare data for plotting
-                plot_data = feature_data[selected_samples].T.reset_index()
-                plot_data.columns = ['Sample', 'Value']
+                # Prepare data for plotting: extract the single feature row as
+                # a NumPy array and build the long-format frame directly,
+                # avoiding the transpose/reset_index/rename round trip.
+                values = data_df.iloc[row_pos][selected_samples].to_numpy()
+                plot_data = pd.DataFrame({'Sample': selected_samples, 'Value': values})
 
                 # --- FIX: Only merge if the grouping column is not 'Sample' ---
                 if selected_group != 'Sample':
-                    # Merge with metadata to get grouping information
-                    plot_data = pd.merge(plot_data, metadata_df[['Sample', selected_group]], on='Sample', how='left')
+                    # Look up the grouping attribute for each sample
+                    plot_data[selected_group] = plot_data['Sample'].map(_group_lookup(metadata_bytes, selected_group))
 
                     if plot_data[selected_group].isnull().any():
                         st.warning(f"Some samples are missing a value for the grouping attribute '{selected_group}'. These samples will be excluded from the plot.")
@@ -175,16 +371,38 @@ def main():
                 # --- Display Plot and Download Options ---
                 if not plot_data.empty:
                     # Create the boxplot using Plotly
-                    fig = px.box(
-                        plot_data,
-                        x=selected_group,
-                        y='Value',
-                        color=selected_group,
-                        title=f"Distribution of {selected_feature_id} ({compound_name}) by {selected_group}",
-                        labels={"Value": "Measurement", selected_group: selected_group},
-                        points="all" # Show individual data points
-                    )
+                    if show_all_points:
+                        fig = px.box(
+                            plot_data,
+                            x=selected_group,
+                            y='Value',
+                            color=selected_group,
+                            labels={"Value": "Measurement", selected_group: selected_group},
+                            points="all"
+                        )
+                        # Small markers keep the SVG vertex count down
+                        fig.update_traces(marker=dict(size=3))
+                    else:
+                        # Precompute the box statistics server-side: only the
+                        # five summary numbers and the outliers per group go
+                        # to the browser and the image exporter, instead of
+                        # every raw sample value.
+                        import plotly.graph_objects as go
+                        fig = go.Figure()
+                        for group_name, group_values in plot_data.groupby(selected_group)['Value']:
+                            stats = _box_stats(group_values.to_numpy(dtype=float))
+                            if stats is None:
+                                continue
+                            q1, median, q3, lower, upper, outliers = stats
+                            fig.add_trace(go.Box(
+                                name=str(group_name),
+                                q1=[q1], median=[median], q3=[q3],
+                                lowerfence=[lower], upperfence=[upper],
+                                y=[outliers.tolist()],
+                                boxpoints='outliers'
+                            ))
                     fig.update_layout(
+                        title=f"Distribution of {selected_feature_id} ({compound_name}) by {selected_group}",
                         title_x=0.5,
                         xaxis_title=selected_group,
                         yaxis_title="Value",
@@ -199,24 +417,22 @@ def main():
                         # Use gap="small" to bring the columns closer together
                         dl_col1, dl_col2 = st.columns(spec=2, gap="small")
 
+                        # Renders are cached on the figure JSON, so each
+                        # format is only produced once per distinct plot
+                        fig_json = fig.to_json()
+
                         # PNG Download
-                        png_buffer = io.BytesIO()
-                        fig.write_image(png_buffer, format="png", width=1000, height=600, scale=2)
-                        png_buffer.seek(0)
                         dl_col1.download_button(
                             label="Download as PNG",
-                            data=png_buffer,
+                            data=_render_figure(fig_json, "png"),
                             file_name=f"boxplot_{selected_feature_id}.png",
                             mime="image/png"
                         )
 
                         # SVG Download
-                        svg_buffer = io.BytesIO()
-                        fig.write_image(svg_buffer, format="svg", width=1000, height=600, scale=2)
-                        svg_buffer.seek(0)
                         dl_col2.download_button(
                             label="Download as SVG",
-                            data=svg_buffer,
+                            data=_render_figure(fig_json, "svg"),
                             file_name=f"boxplot_{selected_feature_id}.svg",
                             mime="image/svg+xml"
                         )